@@ -9,12 +9,18 @@ pip3 install --upgrade requirements.txt
 """
 
 import argparse
+import threading
+from functools import lru_cache
+from itertools import zip_longest
 from os.path import exists
+import orjson
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import BatchError, HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from json import load
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 REGISTER_CONFIG_FILE = 'course_registers.json'
@@ -29,8 +35,8 @@ def _get_args():
     parser = argparse.ArgumentParser("Reads students' names from an " + \
         "attendance sheet (Google Sheets) and writes their grades to the " +\
         "class register")
-    parser.add_argument('-l', '--lab', dest='lab_no', type=int, required=True,
-        help='Lab number')
+    parser.add_argument('-l', '--lab', dest='lab_nos', type=int, nargs='+',
+        required=True, help='Lab number(s)')
     parser.add_argument('-t', '--ta', dest='ta', type=str, required=False,
         help="TA acronym")
     parser.add_argument('-c', '--course', dest='course', type=str, required=True,
@@ -39,10 +45,23 @@ def _get_args():
     return parser.parse_args()
 
 
+@lru_cache(maxsize=1)
+def _load_registers():
+    """
+    Parses and caches course_registers.json. Callers that import this module
+    and invoke main() repeatedly only pay the parse once.
+    """
+    with open(REGISTER_CONFIG_FILE, 'rb') as config:
+        return orjson.loads(config.read())
+
+
+@lru_cache(maxsize=1)
 def _login():
     """
     Performs TA login using the token.json file, if present.
-    Otherwise, it uses credentials.json.
+    Otherwise, it uses credentials.json. The resulting service and credentials
+    are cached, so callers that invoke main() repeatedly within one process
+    only build the service once.
     """
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
@@ -63,120 +82,260 @@ def _login():
         with open(TOKEN_FILE, 'w') as token:
             token.write(creds.to_json())
 
-    return build('sheets', 'v4', credentials=creds)
+    # static_discovery uses the discovery document shipped with
+    # google-api-python-client instead of fetching it over the network on
+    # every run.
+    return build('sheets', 'v4', credentials=creds, static_discovery=True,
+        cache_discovery=False), creds
+
+
+_thread_local = threading.local()
+
+
+def _authorized_http(creds):
+    """
+    Returns a per-thread AuthorizedHttp. Each thread keeps its own keepalive
+    connection, so the TLS handshake is paid once per thread instead of once
+    per API call.
+    """
+    if getattr(_thread_local, 'http', None) is None:
+        _thread_local.http = AuthorizedHttp(creds, http=httplib2.Http())
+    return _thread_local.http
+
+
+def _attendees_request(service, attendance_id, lab_no):
+    """
+    Builds (without executing) the request that reads lab attendees' Moodle
+    IDs and grades from the attendance sheet.
+    """
+    attendance_range = f'Prezenta lab {lab_no}!D2:E'
+    return service.spreadsheets().values().get(
+        spreadsheetId=attendance_id, range=attendance_range)
 
 
-def _get_attendees(service, attendance_id, lab_no):
+def _parse_attendees(response):
     """
     Returns a list of tuples made up of lab attendees' Moodle IDs and their
     grades.
     """
-    attendance_range = f'Prezenta lab {lab_no}!D2:E'
-    students_lab = service.spreadsheets().values().get(
-        spreadsheetId=attendance_id, range=attendance_range).execute()['values']
+    return [s for s in response['values'] if s[0] != '#N/A']
+
+
+def _register_request(service, register_id, sheets, moodle_ids, lab_col):
+    """
+    Builds (without executing) the batchGet request that reads the Moodle IDs
+    and the lab's grades of every register sheet in one round-trip.
+    """
+    ranges = []
+    for sheet in sheets:
+        ranges.append('%s!%s' % (sheet, moodle_ids))
+        ranges.append('%s!%s' % (sheet, lab_col))
 
-    return list(filter(lambda s: s[0] != '#N/A', students_lab))
+    return service.spreadsheets().values().batchGet(
+        spreadsheetId=register_id, ranges=ranges)
 
 
-def _get_register_range(service, register, sheet, lab_no):
+def _fetch_lab(service, creds, attendance_id, register_id, sheets, moodle_ids,
+        lab_col, lab_no):
     """
-    Returns the following dictionary:
-        - keys = students' Moodle IDs
-        - values = tuple(index in the grades list, grade)
+    Executes the attendance read and the register read. They target different
+    spreadsheets, so they cannot share a batchGet; instead both are
+    multiplexed into a single /batch HTTP call. Some Google endpoints refuse
+    batching (501), in which case the two requests fall back to running
+    sequentially on the shared transport.
     """
-    ranges = [
-        f'{sheet}!{register["moodle_ids"]}',
-        f'{sheet}!{register["lab_cols"][lab_no]}'
-    ]
-    grades = service.spreadsheets().values().batchGet(
-        spreadsheetId=register['register_id'], ranges=ranges).execute()
+    attendance_req = _attendees_request(service, attendance_id, lab_no)
+    register_req = _register_request(service, register_id, sheets, moodle_ids,
+        lab_col)
 
-    stud_names = grades['valueRanges'][0]['values']
-    stud_grades = grades['valueRanges'][1].get('values', [])
-    stud_grades += [[]] * (len(stud_names) - len(stud_grades))
-    both = zip(stud_names, stud_grades)
+    responses = {}
 
-    return { k[0]: (v, i) for i, (k, v) in enumerate(both) }
+    def _collect(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        responses[request_id] = response
 
+    try:
+        batch = service.new_batch_http_request(callback=_collect)
+        batch.add(attendance_req, request_id='attendance')
+        batch.add(register_req, request_id='register')
+        batch.execute(http=_authorized_http(creds))
 
-def _make_value_range(sheet, col, idx, value):
+        return responses['attendance'], responses['register']
+    except (BatchError, HttpError):
+        return (attendance_req.execute(http=_authorized_http(creds)),
+            register_req.execute(http=_authorized_http(creds)))
+
+
+def _parse_register_ranges(sheets, grades):
+    """
+    Returns a list of (sheet, idx_map, grades) triples built from a batchGet
+    response, where idx_map maps students' Moodle IDs to their row index and
+    grades holds the existing grade of each row.
     """
-    Returns one ValueRange object that writes the given value at lab_col[idx].
+    reg_ranges = []
+    for sheet_no, sheet in enumerate(sheets):
+        stud_names = grades['valueRanges'][2 * sheet_no]['values']
+        stud_grades = grades['valueRanges'][2 * sheet_no + 1].get('values', [])
+
+        # zip_longest pads the missing grades on the fly instead of
+        # materialising a throwaway list of empty lists. Keeping the indices
+        # and the grades in two parallel structures avoids allocating a tuple
+        # per student, and pre-sizing the map with all its keys up front
+        # avoids the rehashes it would go through while growing entry by
+        # entry.
+        idx_map = dict.fromkeys(k[0] for k in stud_names)
+        sheet_grades = []
+        for i, (k, v) in enumerate(
+                zip_longest(stud_names, stud_grades, fillvalue=None)):
+            idx_map[k[0]] = i
+            sheet_grades.append(v or [])
+
+        reg_ranges.append((sheet, idx_map, sheet_grades))
+
+    return reg_ranges
+
+
+def _parse_col(col):
+    """
+    Splits an A1 range such as 'X5:X' into its column letter(s) and first row.
     """
-    # lab_col = register['lab_cols'][lab_no]
     pos = col.find(':')
     # TODO: [Bug] This assumes actual grades start from a row < 10.
     # This holds true for most registers, though.
-    col_start = int(col[pos - 1 : pos])
-    col = col[pos + 1 :]
-
-    return {
-        'range': f'{sheet}!{col}{col_start + idx}',
-        'majorDimension': 'ROWS',
-        'values': [[value]]
-    }
+    return col[pos + 1 :], int(col[pos - 1 : pos])
 
 
-def main(course, lab_no, ta):
+def _coalesce_value_ranges(writes):
+    """
+    Turns a list of (sheet, (col, col_start), idx, value) writes into as few
+    ValueRange objects as possible by merging contiguous rows of the same
+    column into a single block. Keeps the batchUpdate body small instead of
+    sending one tiny rectangle per student.
+    """
+    by_col = {}
+    for sheet, col, idx, value in writes:
+        by_col.setdefault((sheet, col), []).append((idx, value))
+
+    value_ranges = []
+    for (sheet, (col, col_start)), cells in by_col.items():
+        cells.sort()
+
+        # Split the sorted cells into maximal runs of consecutive rows and
+        # emit one column-major ValueRange per run.
+        run_start = 0
+        for i in range(1, len(cells) + 1):
+            if i == len(cells) or cells[i][0] != cells[i - 1][0] + 1:
+                first_row = col_start + cells[run_start][0]
+                last_row = col_start + cells[i - 1][0]
+                value_ranges.append({
+                    'range': '%s!%s%d:%s%d' % (sheet, col, first_row, col,
+                        last_row),
+                    'majorDimension': 'COLUMNS',
+                    'values': [[value for _, value in cells[run_start : i]]]
+                })
+                run_start = i
+
+    return value_ranges
+
+
+def main(course, lab_nos, ta):
     """
-    Retrieves the attendance list and grades all studens who haven't been
-    already graded. Also assigns the TA to the subgroup if the ta parameter is
-    specified.
+    Retrieves the attendance lists of the given labs and grades all studens
+    who haven't been already graded. Also assigns the TA to the subgroup if
+    the ta parameter is specified. Grading several labs in one call shares the
+    login and sends a single batchUpdate for all of them.
     """
-    service = _login()
-    register = load(open(REGISTER_CONFIG_FILE))[course]
+    service, creds = _login()
+    register = _load_registers()[course]
+
+    # Unpack the register into locals up front; the loops below and the
+    # helpers they call only deal with plain values, not the config dict.
+    register_id = register['register_id']
+    attendance_id = register['attendance_id']
+    sheets = tuple(register['sheets'])
+    moodle_ids = register['moodle_ids']
+    lab_cols = register['lab_cols']
+
+    # Parse the TA column once instead of once per write.
+    ta_col = _parse_col(register['ta_col']) if ta else None
+
+    writes = []
+    expected_grades = 0
+    # (sheet, idx) pairs whose TA cell is already queued, so a student who
+    # attended several of the graded labs gets the acronym written only once.
+    ta_written = set()
+
+    for lab_no in lab_nos:
+        # Read the attendance list and the register in one pipelined
+        # round-trip.
+        attendance, grades = _fetch_lab(service, creds, attendance_id,
+            register_id, sheets, moodle_ids, lab_cols[lab_no], lab_no)
+        students_lab = _parse_attendees(attendance)
+
+        ungraded_students = any(map(lambda s: len(s) < 2, students_lab))
 
-    # Read students who participated in the lab.
-    students_lab = _get_attendees(service, register['attendance_id'], lab_no)
+        if ungraded_students:
+            print(f"You have at least one student that it's not graded in "
+            f"the attendance list of lab {lab_no}. Please grade all students "
+            "before run the script.")
+            return
+
+        reg_ranges = _parse_register_ranges(sheets, grades)
+        lab_col = _parse_col(lab_cols[lab_no])
+        expected_grades += len(students_lab)
+
+        # Look for the students in all sheets. Stop as soon as every attendee
+        # has been matched, so trailing sheets aren't scanned for nothing.
+        remaining = { s[0] for s in students_lab }
+        for sheet, reg_idx, reg_grades in reg_ranges:
+            for stud, grade in students_lab:
+                if stud not in remaining:
+                    continue
+
+                idx = reg_idx.get(stud)
+                if idx is None:
+                    continue
+
+                remaining.discard(stud)
+                if not reg_grades[idx]:
+                    writes.append((sheet, lab_col, idx, grade))
+                    if ta and (sheet, idx) not in ta_written:
+                        ta_written.add((sheet, idx))
+                        writes.append((sheet, ta_col, idx, ta))
+                else:
+                    print(f'Error: student "{stud}" has already been graded for lab {lab_no}.')
+
+            if not remaining:
+                break
 
     # The skeleton of the request body.
     body = {
         'valueInputOption': 'USER_ENTERED',
-        'data': [ ],
+        'data': _coalesce_value_ranges(writes),
         'includeValuesInResponse': False
     }
 
-    # Look for the students in all sheets.
-    for sheet in register['sheets']:
-        reg_range = _get_register_range(service, register, sheet, lab_no)
-
-        ungraded_students = any(map(lambda s: len(s) < 2, students_lab))
-
-        if ungraded_students:
-            print("You have at least one student that it's not graded in" 
-            "attendance list. Please grade all students before run the script.")
-            return
-
-        for stud, grade in students_lab:
-            if stud in reg_range and len(reg_range[stud][0]) == 0:
-                body['data'].append(_make_value_range(sheet,
-                    register['lab_cols'][lab_no], reg_range[stud][1], grade))
-                if ta:
-                    body['data'].append(_make_value_range(sheet,
-                        register['ta_col'], reg_range[stud][1], ta))
-            elif stud in reg_range:
-                print(f'Error: student "{stud}" has already been graded for lab {lab_no}.')
-
     # Send the update request.
     request = service.spreadsheets().values().batchUpdate(
-        spreadsheetId=register['register_id'], body=body)
-    response = request.execute()
+        spreadsheetId=register_id, body=body)
+    response = request.execute(http=_authorized_http(creds))
 
-    print(f'Class register: https://docs.google.com/spreadsheets/d/{register["register_id"]}')
+    print(f'Class register: https://docs.google.com/spreadsheets/d/{register_id}')
 
     # Print the results.
     updated_cells = response.get('totalUpdatedCells', 0)
-    if (not ta and updated_cells == len(students_lab)) \
-            or (ta and updated_cells == 2 * len(students_lab)):
-        print(f'All students are graded!')
+    expected_cells = expected_grades + len(ta_written)
+    if updated_cells == expected_cells:
+        print('All students are graded!')
     elif updated_cells != 0:
-            print(f'Modified {updated_cells} cells:')
-            for resp in response['responses']:
-                print(resp['updatedRange'])
+        print(f'Modified {updated_cells} cells:')
+        for resp in response.get('responses', ()):
+            print(resp['updatedRange'])
     else:
         print('Fucked up completely :( no cells modified!')
 
 
 if __name__ == '__main__':
     args = _get_args()
-    main(args.course, args.lab_no, args.ta)
+    main(args.course, args.lab_nos, args.ta)